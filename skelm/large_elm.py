@@ -1,31 +1,177 @@
+import os
 import numpy as np
+import scipy as sp
+from collections import deque
+from functools import partial
 from sklearn.base import RegressorMixin
 from sklearn.metrics import pairwise_distances
 from sklearn.utils.validation import check_is_fitted, check_array
 
 import dask.array as da
 import dask.dataframe as dd
+from dask import delayed
 
 from .elm import _BaseELM
 from dask.distributed import Client, LocalCluster, wait
 from .utils import _is_list_of_strings, _dense, HiddenLayerType, dummy
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _read_parquet_array(fname):
+    """Read a Parquet file as a Dask array, with one chunk per row group as stored on disk.
+    """
+    return dd.read_parquet(fname, engine='pyarrow', split_row_groups=True).to_dask_array(lengths=True)
+
+
+def _part_name(i):
+    # zero-padded names keep partitions in order when sorted as strings
+    return "part.{:06d}.parquet".format(i)
+
 
 def _read_numeric_file(fname):
-    try:
-        return dd.read_parquet(fname)
-    except:
-        pass
+    """Read a Parquet, CSV or Numpy data file, choosing a reader by file extension.
 
-    try:
-        return dd.read_csv(fname)
-    except:
-        pass
+    Files without a known extension are recognized by their first bytes; directories are read as Parquet datasets.
+    """
+    readers = {
+        '.parquet': partial(dd.read_parquet, engine='pyarrow', split_row_groups=True),
+        '.csv': dd.read_csv,
+        '.npy': np.load,
+    }
+
+    suffix = os.path.splitext(fname)[1].lower()
+    if suffix in ('.parq', '.pq') or os.path.isdir(fname):
+        suffix = '.parquet'
+
+    if suffix not in readers:
+        with open(fname, 'rb') as f:
+            magic = f.read(8)
+        if magic.startswith(b'PAR1'):
+            suffix = '.parquet'
+        elif magic.startswith(b'\x93NUMPY'):
+            suffix = '.npy'
+        else:
+            raise ValueError("Data file format not understood: {}".format(fname))
+
+    return readers[suffix](fname)
+
+
+def _pairwise_block(X, W, W_sq):
+    """Euclidean distances between data samples `X` and centroids `W`, by one matrix product.
+
+    Uses ||x-w||^2 = ||x||^2 + ||w||^2 - 2xw' with precomputed squared norms of centroids `W_sq`.
+    """
+    D = X @ W.T
+    D *= -2
+    D += np.einsum('ij,ij->i', X, X)[:, None]
+    D += W_sq
+    np.maximum(D, 0, out=D)
+    return np.sqrt(D, out=D)
+
+
+# pairwise metrics with a compiled Numba kernel, and their codes in that kernel;
+# Euclidean distances are computed by matrix products in `_pairwise_block` instead
+_pairwise_nb_metrics = {'manhattan': 0, 'cityblock': 0, 'l1': 0,
+                        'chebyshev': 1}
+
+if numba is not None:
+    def _pairwise_nb_signature(t):
+        # data and centroids may be read-only, like blocks of data read from Parquet files
+        in_array = numba.types.Array(t, 2, 'A', readonly=True)
+        return numba.types.void(in_array, in_array, numba.types.Array(t, 2, 'A'), numba.types.int64)
+
+    # compiled at import, so Dask workers do not re-compile it for every task
+    @numba.njit([_pairwise_nb_signature(numba.types.float64), _pairwise_nb_signature(numba.types.float32)],
+                parallel=True, fastmath=True, cache=True)
+    def _pairwise_nb(X, W, out, kind):
+        """Pairwise distances between `X` and `W` written into `out`; `kind` is a metric code.
+        """
+        for i in numba.prange(X.shape[0]):
+            for j in range(W.shape[0]):
+                d = 0.0
+                for t in range(X.shape[1]):
+                    diff = X[i, t] - W[j, t]
+                    if kind == 0:
+                        d += abs(diff)
+                    else:
+                        d = max(d, abs(diff))
+                out[i, j] = d
+
+
+def _build_H_block(X, layers, include_original_features, dtype):
+    """Compute hidden layer outputs for one block of data, with original features and bias at the end.
+
+    Fills a single pre-allocated output array of type `dtype` instead of concatenating separate parts.
+    The array is Fortran-ordered, so projection neurons are written into it directly by a matrix product,
+    and transformed in-place by Numpy ufuncs.
+    """
+    X = X.astype(dtype, copy=False)
+    n_outputs = sum(layer[1].shape[0] for layer in layers) + 1
+    if include_original_features:
+        n_outputs += X.shape[1]
+
+    H = np.empty((X.shape[0], n_outputs), dtype=dtype, order='F')
+    k = 0
+    for kind, W, ufuncs, metric, W_sq in layers:
+        if W_sq is not None:
+            H[:, k: k + W.shape[0]] = _pairwise_block(X, W, W_sq)
+        elif kind == HiddenLayerType.PAIRWISE and numba is not None and metric in _pairwise_nb_metrics:
+            _pairwise_nb(X, W, H[:, k: k + W.shape[0]], _pairwise_nb_metrics[metric])
+        elif kind == HiddenLayerType.PAIRWISE:
+            H[:, k: k + W.shape[0]] = pairwise_distances(X, W, metric=metric)
+        else:
+            H_part = H[:, k: k + W.shape[0]]
+            np.dot(W, X.T, out=H_part.T)
+            for start, stop, ufunc in ufuncs:
+                if isinstance(ufunc, np.ufunc):
+                    ufunc(H_part[:, start: stop], out=H_part[:, start: stop])
+                elif ufunc is not dummy:
+                    H_part[:, start: stop] = ufunc(H_part[:, start: stop])
+        k += W.shape[0]
+
+    if include_original_features:
+        H[:, k: k + X.shape[1]] = X
+    H[:, -1] = 1
+    return H
+
+
+def _partial_HH_HY(X, Y, layers, include_original_features, dtype):
+    """Compute H'H and H'Y for one block of data, locally on a worker.
+
+    Hidden layer output H is built and reduced within the same task, so it is never stored as a Dask chunk.
+    Products are always computed in double precision, as single precision H'H may lose positive definiteness.
+
+    Symmetric H'H is computed by BLAS `syrk` with half the operations of a full matrix product;
+    only its lower triangle is filled, which is all the Cholesky solver needs.
+    """
+    H = _build_H_block(X, layers, include_original_features, dtype)
+    H = H.astype(np.float64, copy=False)
+    return sp.linalg.blas.dsyrk(1.0, H, trans=1, lower=1), H.T @ Y
+
+
+def _sum_HH_HY(*parts):
+    """Reduce-sum a number of (H'H, H'Y) pairs.
+    """
+    HH, HY = (M.copy(order='K') for M in parts[0])
+    for HH_part, HY_part in parts[1:]:
+        HH += HH_part
+        HY += HY_part
+    return HH, HY
+
+
+def _tree_sum_HH_HY(parts, split_every=4):
+    """Reduce-sum delayed (H'H, H'Y) pairs in a tree, summing `split_every` pairs per task.
+
+    A worker needs memory for only a few H'H matrices at once, regardless of the number of pairs.
+    """
+    while len(parts) > 1:
+        parts = [delayed(_sum_HH_HY)(*parts[k: k + split_every]) for k in range(0, len(parts), split_every)]
+    return parts[0]
 
-    try:
-        return np.load(fname)
-    except:
-        pass
 
 class LargeELMRegressor(_BaseELM, RegressorMixin):
     """ELM Regressor for larger-than-memory problems.
@@ -55,8 +201,6 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
 
     .. todo: Avoid large batch sizes as workers can fail, safe bet is 2000-5000 range.
 
-    .. todo: Fast HtH and in-place Cholesky solver.
-
     .. todo: Pro tip in documentation: run ELM with dummy 1000 data samples and 1e+9 regularization,
         This will test possible memory issues for workers without wasting your time on computing full HH.
 
@@ -74,19 +218,30 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
     Parameters
     ----------
 
+    dtype : numpy dtype, default=np.float32
+        Precision of hidden layer computations. Single precision halves memory traffic and speeds up
+        matrix products, while H'H and H'Y matrices are still accumulated and solved in double precision.
+
     batch_size : int
-        Batch size used for both data samples and hidden neurons. With batch Cholesky solver, allows for very large
-        numbers of hidden neurons of over 100,000; limited only by the computation time and disk swap space.
+        Batch size used for data samples. Hidden layer outputs are computed and reduced into H'H and H'Y
+        matrices one batch at a time, so any number of hidden neurons works with any batch size.
+
+        If row groups in Parquet files are smaller than the batch size, actual batch size is rounded down
+        to a multiple of the row group size, so batches consist of whole row groups as stored on disk.
+        Larger row groups are split into batches. Write data files with the same row group size.
 
         .. hint:: Include bias and original features for best performance.
 
         ELM will include a bias term (1 extra feature), and the original features with `include_original_features=True`.
-        For optimal performance, choose `batch_size` to be equal or evenly divide the
-        `n_neurons + 1 (bias) + n_inputs (if include_original_features=True)`.
 
         .. todo:: Exact batch_size vs. GPU performance
     """
 
+    def __init__(self, alpha=1e-7, batch_size=None, include_original_features=False, n_neurons=None,
+                 ufunc="tanh", density=None, pairwise_metric=None, random_state=None, dtype=np.float32):
+        super().__init__(alpha, batch_size, include_original_features, n_neurons, ufunc, density, pairwise_metric,
+                         random_state)
+        self.dtype = dtype
 
     def __del__(self):
         if hasattr(self, 'client_'):
@@ -96,14 +251,10 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
     def _setup_dask_client(self):
         self.cluster_ = LocalCluster(
             n_workers=4, threads_per_worker=1,
-            local_dir="/Users/akusok/wrkdir/dask-temp",
             memory_limit="8GB"
         )
         self.client_ = Client(self.cluster_)
-
-        W_list = [hl.projection_.components_ for hl in self.hidden_layers_]
-        W_dask = [da.from_array(_dense(W), chunks=self.bsize_) for W in W_list]
-        self.W_ = self.client_.persist(W_dask)
+        self._scatter_layers()
 
         def foo():
             import os
@@ -120,97 +271,122 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
         except:
             pass
 
+    def _init_layers(self):
+        """Prepare hidden layer parameters for computing H in Numpy kernels.
+
+        All projection layers are stacked into one matrix, so their neurons are computed by a single
+        matrix product followed by per-layer ufuncs. Pairwise layers come after them.
+
+        Dense projection matrices are stored in `layers_` once, and reused by all `fit` and `predict` calls.
+        Euclidean pairwise layers also get squared norms of their centroids.
+        """
+        projection = [hl for hl in self.hidden_layers_ if hl.hidden_layer_ != HiddenLayerType.PAIRWISE]
+        pairwise = [hl for hl in self.hidden_layers_ if hl.hidden_layer_ == HiddenLayerType.PAIRWISE]
+        self.layers_ = []
+
+        if len(projection) > 0:
+            W = np.ascontiguousarray(np.vstack([_dense(hl.projection_.components_) for hl in projection]),
+                                     dtype=self.dtype)
+            ufuncs = []
+            k = 0
+            for hl in projection:
+                n = hl.projection_.components_.shape[0]
+                ufuncs.append((k, k + n, hl.ufunc_))
+                k += n
+            self.layers_.append((HiddenLayerType.RANDOM, W, ufuncs, None, None))
+
+        for hl in pairwise:
+            W = np.ascontiguousarray(_dense(hl.projection_.components_), dtype=self.dtype)
+            W_sq = None
+            if hl.pairwise_metric in ('euclidean', 'l2'):
+                W_sq = np.einsum('ij,ij->i', W, W)
+            self.layers_.append((hl.hidden_layer_, W, None, hl.pairwise_metric, W_sq))
+
+    def _scatter_layers(self):
+        """Send hidden layer parameters to all workers once, instead of serializing them into every task.
+        """
+        [self.layers_future_] = self.client_.scatter([self.layers_], broadcast=True)
+
     def _project(self, X_dask):
         """Compute hidden layer output with Dask functionality.
         """
-        H_list = []
-        for hl, W in zip(self.hidden_layers_, self.W_):
-            if hl.hidden_layer_ == HiddenLayerType.PAIRWISE:
-                H0 = X_dask.map_blocks(
-                    pairwise_distances,
-                    W,
-                    dtype=X_dask.dtype,
-                    chunks=(X_dask.chunks[0], (W.shape[0],)),
-                    metric=hl.pairwise_metric
-                )
-            else:
-                XW_dask = da.dot(X_dask, W.transpose())
-                if hl.ufunc_ is dummy:
-                    H0 = XW_dask
-                elif hl.ufunc_ is np.tanh:
-                    H0 = da.tanh(XW_dask)
-                else:
-                    H0 = XW_dask.map_blocks(hl.ufunc_)
-            H_list.append(H0)
-
+        X_dask = X_dask.rechunk({0: self.bsize_, 1: -1})
+        n_neurons = sum(layer[1].shape[0] for layer in self.layers_) + 1
         if self.include_original_features:
-            H_list.append(X_dask)
-        H_list.append(da.ones((X_dask.shape[0], 1)))
-
-        H_dask = da.concatenate(H_list, axis=1).rechunk(self.bsize_)
+            n_neurons += X_dask.shape[1]
+
+        H_dask = X_dask.map_blocks(
+            _build_H_block,
+            self.layers_future_,
+            self.include_original_features,
+            self.dtype,
+            dtype=self.dtype,
+            chunks=(X_dask.chunks[0], (n_neurons,))
+        )
         return H_dask
 
-    def _compute(self, X, y, sync_every, HH=None, HY=None):
+    def _compute(self, X, y, sync_every, prefetch=2, HH=None, HY=None):
         """Computing matrices HH and HY, the actually long part.
 
-        .. todo: actually distributed computations that scatter batches of data file names,
-            and reduce-sum the HH,HY matrices.
+        Each data file is reduced to a pair of Numpy matrices H'H and H'Y on workers, and added to the running sum.
+        Dask graph stays small: one task per block of data, and a tree reduction with a few tasks per file.
+        Up to `prefetch` files are computed at once, while the next file is read and submitted.
+
+        .. todo: actually distributed computations that scatter batches of data file names.
         """
+        HH_HY = None if HH is None else (HH, HY)
+        in_flight = deque()
 
         # processing files
         for i, X_file, y_file in zip(range(len(X)), X, y):
-            X_dask = dd.read_parquet(X_file).to_dask_array(lengths=True)
-            Y_dask = dd.read_parquet(y_file).to_dask_array(lengths=True)
-            H_dask = self._project(X_dask)
-
-            if HH is None:  # first iteration
-                HH = da.dot(H_dask.transpose(), H_dask)
-                HY = da.dot(H_dask.transpose(), Y_dask)
-            else:
-                HH += da.dot(H_dask.transpose(), H_dask)
-                HY += da.dot(H_dask.transpose(), Y_dask)
-                if sync_every is not None and i % sync_every == 0:
-                    wait([HH, HY])
-
-            # synchronization
-            if sync_every is not None and i % sync_every == 0:
-                HH, HY = self.client_.persist([HH, HY])
+            X_dask = _read_parquet_array(X_file)
+            Y_dask = _read_parquet_array(y_file)
+            X_dask = X_dask.rechunk({0: self.bsize_, 1: -1})
+            Y_dask = Y_dask.rechunk({0: X_dask.chunks[0], 1: -1})
+
+            parts = [delayed(_partial_HH_HY)(X_block, Y_block, self.layers_future_,
+                                             self.include_original_features, self.dtype)
+                     for X_block, Y_block in zip(X_dask.to_delayed().ravel(), Y_dask.to_delayed().ravel())]
+            HH_HY_file = _tree_sum_HH_HY(parts)
+            if HH_HY is not None:
+                HH_HY_file = delayed(_sum_HH_HY)(HH_HY_file, HH_HY)
+            HH_HY = self.client_.compute(HH_HY_file)
+
+            # limit number of files in flight, reading next files while the previous ones are computed;
+            # finished futures are released so their results do not stay pinned on workers
+            if prefetch is not None:
+                in_flight.append(HH_HY)
+                while in_flight and in_flight[0].done():
+                    in_flight.popleft()
+                if len(in_flight) > prefetch:
+                    wait(in_flight.popleft())
+
+            # synchronization, skipping the first file that has nothing to synchronize yet
+            if sync_every is not None and i > 0 and i % sync_every == 0:
+                wait(HH_HY)
+                in_flight.clear()
 
         # finishing solution
-        if sync_every is not None:
-            wait([HH, HY])
+        HH, HY = HH_HY.result()
         return HH, HY
 
     def _solve(self, HH, HY):
-        """Compute output weights from HH and HY using Dask functionality.
+        """Compute output weights from HH and HY with Cholesky decomposition.
+
+        HH + alpha*I is symmetric positive definite, and small enough to solve in memory as it has
+        a size of (n_neurons, n_neurons). Regularization and Cholesky decomposition overwrite HH in-place,
+        so only one such matrix is kept in memory. Only the lower triangle of HH is used.
         """
-        # make HH/HY divisible by chunk size
-        n_features, _ = HH.shape
-        padding = 0
-        if n_features > self.bsize_ and n_features % self.bsize_ > 0:
-            print("Adjusting batch size {} to n_features {}".format(self.bsize_, n_features))
-            padding = self.bsize_ - (n_features % self.bsize_)
-            P01 = da.zeros((n_features, padding))
-            P10 = da.zeros((padding, n_features))
-            P11 = da.zeros((padding, padding))
-            HH = da.block([[HH,  P01],
-                           [P10, P11]])
-
-            P1 = da.zeros((padding, HY.shape[1]))
-            HY = da.block([[HY],
-                           [P1]])
-
-        # rechunk, add bias, and solve
-        HH = HH.rechunk(self.bsize_) + self.alpha * da.eye(HH.shape[1], chunks=self.bsize_)
-        HY = HY.rechunk(self.bsize_)
-
-        B = da.linalg.solve(HH, HY, sym_pos=True)
-        if padding > 0:
-            B = B[:n_features]
+        # LAPACK works in-place on Fortran-ordered arrays, like HH from `syrk`
+        HH = np.asfortranarray(HH)
 
+        # add regularization, and solve
+        HH[np.diag_indices_from(HH)] += self.alpha
+        L = sp.linalg.cho_factor(HH, lower=True, overwrite_a=True, check_finite=False)
+        B = sp.linalg.cho_solve(L, HY, check_finite=False)
         return B
 
-    def fit(self, X, y=None, sync_every=10):
+    def fit(self, X, y=None, sync_every=10, prefetch=2):
         """Fits an ELM with data in a bunch of files.
 
         Model will use the set of features from the first file.
@@ -222,10 +398,6 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
 
         .. todo: Check if some sparse data would work.
 
-        .. todo: Check that sync_every does not affect results
-
-        .. todo: Add single precision
-
         .. todo: Parquet file format examples in documentation
 
         Original features and bias are added to the end of data, for easier rechunk-merge. This way full chunks
@@ -246,6 +418,11 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
             Less synchronization improves run speed with smaller data files, but may result in large swap space usage
             for large data problems. Use smaller number for more frequent synchronization if swap space
             becomes a problem.
+
+        prefetch : int or None
+            Number of files processed at the same time. Reading of the next file overlaps with computations
+            on the previous ones, hiding disk latency. Larger values need memory for more files at once.
+            None for no limit.
         """
 
         if not _is_list_of_strings(X) or not _is_list_of_strings(y):
@@ -255,9 +432,16 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
             raise ValueError("Expected X and y as lists of files with the same length. "
                              "Got len(X)={} and len(y)={}".format(len(X), len(y)))
 
+        try:
+            dtype_supported = np.dtype(self.dtype) in (np.float32, np.float64)
+        except TypeError:
+            dtype_supported = False
+        if not dtype_supported:
+            raise ValueError("Expected dtype as np.float32 or np.float64, got {}".format(self.dtype))
+
         # read first file and get parameters
-        X_dask = dd.read_parquet(X[0]).to_dask_array(lengths=True)
-        Y_dask = dd.read_parquet(y[0]).to_dask_array(lengths=True)
+        X_dask = _read_parquet_array(X[0])
+        Y_dask = _read_parquet_array(y[0])
 
         n_samples, n_features = X_dask.shape
         if hasattr(self, 'n_features_') and self.n_features_ != n_features:
@@ -272,6 +456,12 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
         if self.bsize_ is None:
             self.bsize_ = n_samples if n_samples < 10 * 1000 else 2000
 
+        # align batches with Parquet row groups, read one per chunk; re-chunking then merges whole row groups
+        # that are smaller than a batch, while larger row groups are split into batches
+        rg_size = X_dask.chunks[0][0]
+        if 0 < rg_size <= self.bsize_:
+            self.bsize_ = (self.bsize_ // rg_size) * rg_size
+
         # init model if not fit yet
         if not hasattr(self, 'hidden_layers_'):
             self.n_features_ = n_features
@@ -279,14 +469,20 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
 
             X_sample = X_dask[:10].compute()
             self._init_hidden_layers(X_sample)
+            self._init_layers()
             self._setup_dask_client()
 
-        HH, HY = self._compute(X, y, sync_every=sync_every)
+        # re-cast hidden layer parameters if `dtype` was changed since the previous fit
+        elif self.layers_[0][1].dtype != np.dtype(self.dtype):
+            self._init_layers()
+            self._scatter_layers()
+
+        HH, HY = self._compute(X, y, sync_every=sync_every, prefetch=prefetch)
         self.B = self._solve(HH, HY)
         self.is_fitted_ = True
         return self
 
-    def predict(self, X):
+    def predict(self, X, out_path=None):
         """Prediction works with both lists of Parquet files and numeric arrays.
 
         Parameters
@@ -295,6 +491,11 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
         X : array-like, [str]
             Input data as list of Parquet files, or as a numeric array.
 
+        out_path : str, optional
+            Directory for writing predictions of Parquet file inputs, instead of returning them.
+            Predictions for each input file are computed and written to disk separately,
+            so they never need to fit in memory together. Only supported with a list of files as input.
+
         Returns
         -------
         Yh : array, shape (n_samples, n_outputs)
@@ -303,16 +504,39 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
             .. attention:: Returns all outputs as a single in-memory array!
 
                 Danger of running out out memory for high-dimensional outputs, if a large set of input
-                files is provided. Feed data in smaller batches in such case.
+                files is provided. Feed data in smaller batches in such case, or use `out_path`.
+
+        Yh_files : [str]
+            Returned instead of Yh if `out_path` is given. List of Parquet datasets with predicted values,
+            named `part<i>.parquet` for the i-th input file.
         """
         check_is_fitted(self, 'is_fitted_')
 
-        if _is_list_of_strings(X):
+        if out_path is not None and not _is_list_of_strings(X):
+            raise ValueError("Writing predictions to `out_path` requires X as a list of Parquet files.")
+
+        if _is_list_of_strings(X) and out_path is not None:
+            Yh_files = []
+            columns = [str(c) for c in range(self.B.shape[1])]
+
+            # processing files one at a time
+            for i, X_file in enumerate(X):
+                X_dask = _read_parquet_array(X_file)
+                Yh_dask = da.dot(self._project(X_dask), self.B)
+                Yh_file = os.path.join(out_path, "part{}.parquet".format(i))
+                Yh_write = dd.from_dask_array(Yh_dask, columns=columns).to_parquet(
+                    Yh_file, engine='pyarrow', name_function=_part_name, compute=False)
+                self.client_.compute(Yh_write).result()
+                Yh_files.append(Yh_file)
+
+            return Yh_files
+
+        elif _is_list_of_strings(X):
             Yh_list = []
 
             # processing files
             for X_file in X:
-                X_dask = dd.read_parquet(X_file).to_dask_array(lengths=True)
+                X_dask = _read_parquet_array(X_file)
                 H_dask = self._project(X_dask)
                 Yh_list.append(da.dot(H_dask, self.B))
 
@@ -320,10 +544,6 @@ class LargeELMRegressor(_BaseELM, RegressorMixin):
             return Yh_dask.compute()
 
         else:
-            X = check_array(X, accept_sparse=True)
-            H = [np.ones((X.shape[0], 1))]
-            if self.include_original_features:
-                H.append(_dense(X))
-            H.extend([hl.transform(X) for hl in self.hidden_layers_])
-
-            return np.hstack(H) @ self.B.compute()
+            X = np.asarray(_dense(check_array(X, accept_sparse=True)))
+            H = _build_H_block(X, self.layers_, self.include_original_features, self.dtype)
+            return H @ self.B
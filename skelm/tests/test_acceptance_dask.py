@@ -3,7 +3,10 @@ from pytest import approx
 import numpy as np
 from tempfile import TemporaryDirectory
 from sklearn.datasets import load_iris, make_multilabel_classification, load_diabetes
+from sklearn.metrics import pairwise_distances
 from skelm import LargeELMRegressor
+from skelm.hidden_layer import HiddenLayerType
+from skelm.large_elm import _build_H_block, _pairwise_block, _pairwise_nb_metrics, _read_numeric_file, _tree_sum_HH_HY
 
 pd = pytest.importorskip("pandas")  # tests if Pandas is installed
 pytest.importorskip("pyarrow")
@@ -22,6 +25,29 @@ def data_ml():
 def data_reg():
     return load_diabetes(return_X_y=True)
 
+@pytest.fixture
+def parquet_files(data_reg, tmp_path):
+    """Writes regression data into Parquet files, returns lists of X and y file names.
+    """
+    X, y = data_reg
+
+    def write(n_files=1, row_group_size=None, as_directory=False):
+        X_dir, y_dir = tmp_path / "X", tmp_path / "y"
+        X_dir.mkdir(exist_ok=True)
+        y_dir.mkdir(exist_ok=True)
+        X_files = [str(X_dir / "part.{}.parquet".format(i)) for i in range(n_files)]
+        y_files = [str(y_dir / "part.{}.parquet".format(i)) for i in range(n_files)]
+        for i in range(n_files):
+            pd.DataFrame(X[i::n_files], columns=[str(c) for c in range(X.shape[1])]).to_parquet(
+                X_files[i], row_group_size=row_group_size)
+            pd.DataFrame(y[i::n_files], columns=['Class']).to_parquet(y_files[i])
+
+        if as_directory:
+            return [str(X_dir)], [str(y_dir)]
+        return X_files, y_files
+
+    return write
+
 
 def test_Input_DifferentLengths_Raises():
     elm = LargeELMRegressor()
@@ -43,3 +69,138 @@ def test_Input_MultipleFiles(data_reg):
         y_hat = elm.predict(X_files)
 
         assert np.mean(y_hat != y) < 0.33
+
+
+def test_PairwiseBlock_Euclidean_MatchesPairwiseDistances(data_reg):
+    X, _ = data_reg
+    W = np.random.randn(20, X.shape[1])
+    D = _pairwise_block(X, W, (W**2).sum(axis=1))
+    assert D == approx(pairwise_distances(X, W, metric="euclidean"))
+
+
+@pytest.mark.parametrize("metric", ["manhattan", "chebyshev"])
+def test_PairwiseNumba_MatchesPairwiseDistances(data_reg, metric):
+    pytest.importorskip("numba")
+    from skelm.large_elm import _pairwise_nb
+
+    X, _ = data_reg
+    W = np.random.randn(20, X.shape[1])
+    D = np.empty((X.shape[0], W.shape[0]))
+    _pairwise_nb(X, W, D, _pairwise_nb_metrics[metric])
+    assert D == approx(pairwise_distances(X, W, metric=metric))
+
+
+def test_Predict_OutPath_WritesSamePredictions(parquet_files, tmp_path):
+    X_files, y_files = parquet_files(n_files=3)
+
+    elm = LargeELMRegressor(batch_size=10)
+    elm.fit(X_files, y_files)
+    y_hat = elm.predict(X_files)
+    y_hat_files = elm.predict(X_files, out_path=str(tmp_path))
+
+    assert len(y_hat_files) == len(X_files)
+    y_hat_disk = np.vstack([pd.read_parquet(f).values for f in y_hat_files])
+    assert y_hat_disk == approx(y_hat)
+
+
+def test_ReadNumericFile_DispatchesByFormat(data_reg, tmp_path):
+    X, _ = data_reg
+    df = pd.DataFrame(X, columns=[str(c) for c in range(X.shape[1])])
+    data_dir = str(tmp_path)
+    df.to_parquet(data_dir + "/X.parquet")
+    df.to_parquet(data_dir + "/X_parquet_data")
+    df.to_csv(data_dir + "/X.csv", index=False)
+    np.save(data_dir + "/X.npy", X)
+    with open(data_dir + "/X.dat", "w") as f:
+        f.write("not a data file")
+
+    assert _read_numeric_file(data_dir + "/X.parquet").compute(scheduler="sync").values == approx(X)
+    assert _read_numeric_file(data_dir + "/X_parquet_data").compute(scheduler="sync").values == approx(X)
+    assert _read_numeric_file(data_dir + "/X.csv").compute(scheduler="sync").values == approx(X)
+    assert _read_numeric_file(data_dir + "/X.npy") == approx(X)
+    with pytest.raises(ValueError):
+        _read_numeric_file(data_dir + "/X.dat")
+
+
+def test_Predict_OutPathWithArrayInput_Raises(data_reg, parquet_files, tmp_path):
+    X, _ = data_reg
+    X_files, y_files = parquet_files()
+
+    elm = LargeELMRegressor(batch_size=100).fit(X_files, y_files)
+    with pytest.raises(ValueError):
+        elm.predict(X, out_path=str(tmp_path))
+
+
+@pytest.mark.parametrize("batch_size,bsize", [(250, 200), (100, 100), (50, 50)])
+def test_BatchSize_AlignedWithRowGroups(parquet_files, batch_size, bsize):
+    X_files, y_files = parquet_files(row_group_size=100)
+
+    elm = LargeELMRegressor(batch_size=batch_size).fit(X_files, y_files)
+    assert elm.bsize_ == bsize
+
+
+def test_Input_ParquetDirectory(data_reg, parquet_files):
+    X, _ = data_reg
+    X_dirs, y_dirs = parquet_files(n_files=3, as_directory=True)
+
+    elm = LargeELMRegressor(batch_size=100).fit(X_dirs, y_dirs)
+    assert elm.predict(X_dirs).shape == (X.shape[0], 1)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_PairwiseNumba_ReadOnlyData_BuildsH(data_reg, dtype):
+    pytest.importorskip("numba")
+
+    X, _ = data_reg
+    X = X.astype(dtype)
+    X.setflags(write=False)
+    W = np.random.randn(20, X.shape[1]).astype(dtype)
+    W.setflags(write=False)
+    layers = [(HiddenLayerType.PAIRWISE, W, None, "chebyshev", None)]
+
+    H = _build_H_block(X, layers, False, dtype)
+    assert H[:, :-1] == approx(pairwise_distances(X, W, metric="chebyshev"), rel=1e-5)
+    assert H[:, -1] == approx(1)
+
+
+def test_TreeSum_MatchesSum():
+    pairs = [(np.random.randn(5, 5), np.random.randn(5, 2)) for _ in range(11)]
+    HH, HY = _tree_sum_HH_HY(pairs, split_every=3).compute(scheduler="sync")
+    assert HH == approx(sum(p[0] for p in pairs))
+    assert HY == approx(sum(p[1] for p in pairs))
+
+
+@pytest.mark.parametrize("dtype", [np.int32, np.float16, "not a dtype"])
+def test_Dtype_Unsupported_Raises(dtype):
+    elm = LargeELMRegressor(dtype=dtype)
+    with pytest.raises(ValueError):
+        elm.fit(['a'], ['b'])
+
+
+def test_Dtype_SingleAndDoublePrecision_GiveClosePredictions(parquet_files):
+    X_files, y_files = parquet_files()
+
+    kwargs = dict(batch_size=100, n_neurons=(30, 20), pairwise_metric=(None, 'euclidean'), random_state=0)
+    y_hat_32 = LargeELMRegressor(dtype=np.float32, **kwargs).fit(X_files, y_files).predict(X_files)
+    y_hat_64 = LargeELMRegressor(dtype=np.float64, **kwargs).fit(X_files, y_files).predict(X_files)
+    assert y_hat_32 == approx(y_hat_64, rel=1e-3)
+
+
+def test_SyncEveryPrefetch_DoNotAffectResults(parquet_files):
+    X_files, y_files = parquet_files(n_files=3)
+
+    elm = LargeELMRegressor(batch_size=100, random_state=0)
+    B = elm.fit(X_files, y_files).B
+    for sync_every, prefetch in [(None, None), (1, 1)]:
+        elm.fit(X_files, y_files, sync_every=sync_every, prefetch=prefetch)
+        assert elm.B == approx(B)
+
+
+def test_Dtype_ChangedBeforeRefit_Works(parquet_files):
+    X_files, y_files = parquet_files()
+
+    elm = LargeELMRegressor(batch_size=100, dtype=np.float64, random_state=0).fit(X_files, y_files)
+    y_hat_64 = elm.predict(X_files)
+    elm.set_params(dtype=np.float32).fit(X_files, y_files)
+    assert elm.layers_[0][1].dtype == np.float32
+    assert elm.predict(X_files) == approx(y_hat_64, rel=1e-3)